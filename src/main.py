@@ -1,26 +1,38 @@
 import telebot
 import sqlite3
-import json
+import orjson
 import configparser
 from datetime import datetime
 import requests
-from typing import Optional, Dict, Any, List, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import re
+import threading
+import time
+import queue
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
 # Конфигурация приложения
 config = configparser.ConfigParser()
 config.read('config.ini')
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования: обработчики пишут в очередь, запись на диск идет в отдельном потоке
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [logging.FileHandler('bot.log'), logging.StreamHandler()]
+for log_handler in log_handlers:
+    log_handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Константы
@@ -29,13 +41,74 @@ BOT_ID = config.getint('API', 'BOT_ID', fallback=25590)
 TIMEOUT = config.getint('API', 'TIMEOUT', fallback=30)
 MAX_RETRIES = config.getint('API', 'MAX_RETRIES', fallback=3)
 TOKEN = config.get('TELEGRAM', 'TOKEN', fallback='7815995188:AAGA8e4dC_Gk1do6-gddvVxKO0ceQUIueUs')
+FILE_URL_PREFIX = f"https://api.telegram.org/file/bot{TOKEN}/"
+MESSAGE_LIMIT = 4096
+SEND_RATE = config.getint('TELEGRAM', 'SEND_RATE', fallback=30)
+PAGE_SIZE = config.getint('TELEGRAM', 'PAGE_SIZE', fallback=50)
+NUM_THREADS = config.getint('TELEGRAM', 'NUM_THREADS', fallback=16)
+MAINTENANCE_INTERVAL = config.getint('DATABASE', 'MAINTENANCE_INTERVAL', fallback=24 * 60 * 60)
+
+# Кнопки выбора критерия поиска и соответствующие им поля
+SEARCH_BUTTONS = {
+    "По названию": 'name',
+    "По ИНН": 'inn',
+    "По email": 'email'
+}
+
+# Допустимые поля поиска и колонки таблицы companies, по которым он выполняется
+SEARCH_COLUMNS = {
+    'name': 'name_lower',
+    'inn': 'inn',
+    'email': 'email_lower'
+}
+
+# Регулярные выражения
+_FIELD_RE = re.compile(r'^[ \t]*(Название|ИНН|Телефон|Контактное лицо|Email):[ \t]*(.*)$', re.M)
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+# ASCII-цифры (str.isdigit пропускает и другие цифровые символы Unicode)
+_DIGITS = frozenset('0123456789')
+
+# Весовые коэффициенты контрольных разрядов ИНН
+_INN10_WEIGHTS = (2, 4, 10, 3, 5, 9, 4, 6, 8)
+_INN12_WEIGHTS_1 = (7, 2, 4, 10, 3, 5, 9, 4, 6, 8)
+_INN12_WEIGHTS_2 = (3, 7, 2, 4, 10, 3, 5, 9, 4, 6, 8)
+
+# Символы, допустимые в записи телефона помимо цифр
+_PHONE_STRIP = str.maketrans('', '', '+ -()')
+
+# Соответствие меток ответа API полям компании
+FIELD_LABELS = {
+    'Название': 'name',
+    'ИНН': 'inn',
+    'Телефон': 'phone',
+    'Контактное лицо': 'contact_person',
+    'Email': 'email'
+}
+REQUIRED_LABELS = ('Название', 'ИНН', 'Email')
+
+# Получение вложения по типу сообщения (для фото берется самый крупный размер)
+FILE_EXTRACTORS = {
+    'document': lambda message: message.document,
+    'photo': lambda message: message.photo[-1],
+    'audio': lambda message: message.audio,
+    'video': lambda message: message.video
+}
+
+# Общий пул соединений для исходящих запросов к Telegram
+telebot.apihelper.session = requests.Session()
+telebot.apihelper.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=NUM_THREADS))
 
 # Инициализация бота
-bot = telebot.TeleBot(TOKEN)
+bot = telebot.TeleBot(TOKEN, threaded=True, num_threads=NUM_THREADS)
 
-# Глобальные переменные для хранения состояния
+# Состояние диалога для каждого чата: одновременно активен только один сценарий
 user_states = {}
-search_states = {}
+
+
+def _lower(value: Optional[str]) -> Optional[str]:
+    """Приведение значения к нижнему регистру для поиска без учета регистра"""
+    return value.lower() if value else value
 
 
 class DatabaseManager:
@@ -43,13 +116,24 @@ class DatabaseManager:
 
     def __init__(self, db_name: str = 'companies.db'):
         self.db_name = db_name
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_name, check_same_thread=False, isolation_level=None,
+                                    cached_statements=256)
+        self.cursor = self.conn.cursor()
+        # page_size действует только до перевода новой базы в режим WAL
+        self.conn.execute('PRAGMA page_size=8192')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        self.conn.execute('PRAGMA cache_size=-20000')
+        self.conn.execute('PRAGMA mmap_size=268435456')
         self.init_db()
+        self.maintenance()
 
     def init_db(self):
         """Инициализация структуры базы данных"""
-        with sqlite3.connect(self.db_name) as db:
-            cursor = db.cursor()
-            cursor.execute('''
+        with self._lock:
+            self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS companies (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL,
@@ -57,11 +141,14 @@ class DatabaseManager:
                 phone TEXT,
                 contact_person TEXT,
                 email TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                name_lower TEXT,
+                email_lower TEXT
             )
             ''')
+            self._migrate_lower_columns()
 
-            cursor.execute('''
+            self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS files (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 company_id INTEGER,
@@ -72,70 +159,113 @@ class DatabaseManager:
                 FOREIGN KEY (company_id) REFERENCES companies(id)
             )
             ''')
-            db.commit()
-
-    def save_company(self, company_data: Dict[str, Any]) -> int:
-        """Сохранение компании в базу данных"""
-        with sqlite3.connect(self.db_name) as db:
-            cursor = db.cursor()
-            cursor.execute('''
-            INSERT INTO companies (name, inn, phone, contact_person, email)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (
-                company_data.get('name'),
-                company_data.get('inn'),
-                company_data.get('phone'),
-                company_data.get('contact_person'),
-                company_data.get('email')
-            ))
-
-            company_id = cursor.lastrowid
-            db.commit()
-            return company_id
 
-    def save_file(self, company_id: int, file_url: str, file_type: str, caption: Optional[str] = None):
-        """Сохранение файла в базу данных"""
-        with sqlite3.connect(self.db_name) as db:
-            cursor = db.cursor()
-            cursor.execute('''
-            INSERT INTO files (company_id, file_url, file_type, caption)
-            VALUES (?, ?, ?, ?)
-            ''', (company_id, file_url, file_type, caption))
-            db.commit()
-
-    def search_company(self, search_type: str, search_value: str) -> List[Tuple]:
-        """Поиск компании в базе данных"""
-        field_map = {
-            'названию': 'name',
-            'инн': 'inn',
-            'email': 'email'
-        }
+            # Поиск по name/email идет по колонкам в нижнем регистре
+            self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_companies_name_lower ON companies(name_lower)')
+            self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_companies_inn ON companies(inn)')
+            self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_companies_email_lower ON companies(email_lower)')
+
+    def _migrate_lower_columns(self):
+        """Добавление и заполнение колонок name_lower/email_lower в существующей базе"""
+        columns = {row[1] for row in self.cursor.execute('PRAGMA table_info(companies)').fetchall()}
+        if {'name_lower', 'email_lower'} <= columns:
+            return
+
+        self.cursor.execute('BEGIN')
+        try:
+            for column in ('name_lower', 'email_lower'):
+                if column not in columns:
+                    self.cursor.execute(f'ALTER TABLE companies ADD COLUMN {column} TEXT')
+            rows = self.cursor.execute('SELECT id, name, email FROM companies').fetchall()
+            self.cursor.executemany(
+                'UPDATE companies SET name_lower = ?, email_lower = ? WHERE id = ?',
+                [(_lower(name), _lower(email), company_id) for company_id, name, email in rows]
+            )
+        except Exception:
+            self.cursor.execute('ROLLBACK')
+            raise
+        self.cursor.execute('COMMIT')
+
+    def maintenance(self):
+        """Обновление статистики планировщика запросов"""
+        with self._lock:
+            self.cursor.execute('ANALYZE')
+
+    def save_company(self, company_data: Dict[str, Any], files: Optional[List[Dict[str, Any]]] = None) -> int:
+        """Сохранение компании и ее файлов в базу данных одной транзакцией"""
+        with self._lock:
+            self.cursor.execute('BEGIN')
+            try:
+                # fetchall() доводит INSERT ... RETURNING до конца
+                rows = self.cursor.execute('''
+                INSERT INTO companies (name, inn, phone, contact_person, email, name_lower, email_lower)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
+                ''', (
+                    company_data.get('name'),
+                    company_data.get('inn'),
+                    company_data.get('phone'),
+                    company_data.get('contact_person'),
+                    company_data.get('email'),
+                    _lower(company_data.get('name')),
+                    _lower(company_data.get('email'))
+                )).fetchall()
+                company_id = rows[0][0]
+
+                if files:
+                    self.cursor.executemany('''
+                    INSERT INTO files (company_id, file_url, file_type, caption)
+                    VALUES (?, ?, ?, ?)
+                    ''', [(company_id, f['url'], f['type'], f.get('caption')) for f in files])
+            except Exception:
+                self.cursor.execute('ROLLBACK')
+                raise
+            self.cursor.execute('COMMIT')
+            return company_id
 
-        field = field_map.get(search_type.lower())
-        if not field:
+    def search_company(self, field: str, search_value: str) -> List[Tuple]:
+        """Поиск компании в базе данных по колонке name, inn или email"""
+        # Имя колонки подставляется в SQL, поэтому допускаются только известные поля
+        if field not in SEARCH_COLUMNS:
             return []
 
-        with sqlite3.connect(self.db_name) as db:
-            cursor = db.cursor()
-            cursor.execute(f'''
-            SELECT * FROM companies 
-            WHERE {field} LIKE ?
-            ''', (f'%{search_value}%',))
-            return cursor.fetchall()
-
-    def get_all_companies(self) -> List[Tuple]:
-        """Получение всех компаний из базы данных"""
-        with sqlite3.connect(self.db_name) as db:
-            cursor = db.cursor()
-            cursor.execute('SELECT * FROM companies ORDER BY created_at DESC')
+        # name и email ищутся без учета регистра по колонкам *_lower
+        column = SEARCH_COLUMNS[field]
+        if column != field:
+            search_value = search_value.lower()
+
+        if '%' in search_value or '*' in search_value:
+            # Пользователь задал шаблон сам: '%' приводим к синтаксису GLOB
+            query = f'SELECT * FROM companies WHERE {column} GLOB ?'
+            params = (search_value.replace('%', '*'),)
+        elif field == 'inn' and search_value.isdigit() and len(search_value) in (10, 12):
+            # Полный ИНН ищется точным совпадением по индексу
+            query = 'SELECT * FROM companies WHERE inn = ?'
+            params = (search_value,)
+        else:
+            query = f'SELECT * FROM companies WHERE {column} LIKE ?'
+            params = (f'%{search_value}%',)
+
+        with self._lock:
+            return self.cursor.execute(query, params).fetchall()
+
+    def get_all_companies(self, limit: int = PAGE_SIZE, before_id: Optional[int] = None) -> List[Tuple]:
+        """Получение страницы компаний (от новых к старым) с id меньше before_id"""
+        with self._lock:
+            if before_id is None:
+                cursor = self.cursor.execute('SELECT * FROM companies ORDER BY id DESC LIMIT ?', (limit,))
+            else:
+                cursor = self.cursor.execute(
+                    'SELECT * FROM companies WHERE id < ? ORDER BY id DESC LIMIT ?',
+                    (before_id, limit)
+                )
             return cursor.fetchall()
 
     def get_company_by_id(self, company_id: int) -> Optional[Tuple]:
         """Получение компании по ID"""
-        with sqlite3.connect(self.db_name) as db:
-            cursor = db.cursor()
-            cursor.execute('SELECT * FROM companies WHERE id = ?', (company_id,))
-            return cursor.fetchone()
+        with self._lock:
+            rows = self.cursor.execute('SELECT * FROM companies WHERE id = ?', (company_id,)).fetchall()
+            return rows[0] if rows else None
 
 
 class APIClient:
@@ -144,33 +274,118 @@ class APIClient:
     def __init__(self, base_url: str, bot_id: int):
         self.base_url = base_url
         self.bot_id = bot_id
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            # MAX_RETRIES - общее число попыток, включая первую
+            max_retries=Retry(
+                total=max(MAX_RETRIES - 1, 0),
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=['POST']
+            )
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def send_request(self, chat_id: int, message_id: int, content: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Отправка запроса к API"""
         payload = {
             "bot_id": self.bot_id,
             "chat_id": f"chat_{chat_id}_{message_id}",
-            "message": content if isinstance(content, str) else json.dumps(content)
+            "message": content if isinstance(content, str) else orjson.dumps(content).decode()
         }
 
         headers = {'Content-Type': 'application/json'}
 
-        for attempt in range(MAX_RETRIES):
+        response = self.session.post(
+            self.base_url,
+            data=orjson.dumps(payload),
+            headers=headers,
+            timeout=TIMEOUT
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+
+class SendQueue:
+    """Очередь исходящих сообщений с ограничением частоты отправки"""
+
+    def __init__(self, bot: telebot.TeleBot, rate: int = SEND_RATE):
+        self.bot = bot
+        self.rate = rate
+        self.tokens = float(rate)
+        self.last_refill = time.monotonic()
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def put(self, chat_id: int, text: str, reply_markup=None):
+        """Постановка сообщения в очередь на отправку"""
+        self.queue.put((chat_id, text, reply_markup))
+
+    def _acquire(self):
+        """Ожидание свободного токена (token bucket)"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+    def _run(self):
+        """Рабочий поток: отправляет сообщения по порядку"""
+        while True:
+            chat_id, text, reply_markup = self.queue.get()
             try:
-                response = requests.post(
-                    self.base_url,
-                    json=payload,
-                    headers=headers,
-                    timeout=TIMEOUT
-                )
-                response.raise_for_status()
-                return response.json()
-            except (requests.RequestException, requests.Timeout) as e:
-                if attempt == MAX_RETRIES - 1:
+                self._send(chat_id, text, reply_markup)
+            except Exception as e:
+                logger.error(f"Error sending message: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def _send(self, chat_id: int, text: str, reply_markup=None):
+        """Отправка сообщения с повтором после ошибки 429"""
+        while True:
+            self._acquire()
+            try:
+                self.bot.send_message(chat_id, text, reply_markup=reply_markup)
+                return
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 429:
                     raise
-                import time
-                time.sleep(2 ** attempt)
-        return None
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                logger.warning(f"Rate limit hit, retrying in {retry_after}s")
+                time.sleep(retry_after)
+
+
+def pack_messages(blocks, header: str = '', limit: int = MESSAGE_LIMIT) -> Iterator[str]:
+    """Жадная упаковка текстовых блоков в сообщения не длиннее limit"""
+    parts = [header] if header else []
+    size = len(header)
+    header_size = size
+    for block in blocks:
+        block += "\n\n"
+        # Блок, который помещается в одно сообщение, не разрываем,
+        # но заголовок отдельным сообщением не отправляем
+        if size + len(block) > limit and len(block) <= limit and size > header_size:
+            yield ''.join(parts)
+            parts = []
+            size = header_size = 0
+        while size + len(block) > limit:
+            cut = limit - size
+            parts.append(block[:cut])
+            yield ''.join(parts)
+            parts = []
+            size = header_size = 0
+            block = block[cut:]
+        parts.append(block)
+        size += len(block)
+    if parts:
+        yield ''.join(parts)
 
 
 def parse_api_response(response_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
@@ -190,23 +405,17 @@ def parse_api_response(response_data: Dict[str, Any]) -> Optional[Dict[str, Any]
     if not text_data:
         return None
 
+    # Быстрый отказ, если в тексте нет даже меток обязательных полей
+    if not all(f'{label}:' in text_data for label in REQUIRED_LABELS):
+        return None
+
     company_data = {}
-    lines = text_data.split('\n')
-
-    for line in lines:
-        if 'Название:' in line:
-            company_data['name'] = line.replace('Название:', '').strip()
-        elif 'ИНН:' in line:
-            company_data['inn'] = line.replace('ИНН:', '').strip()
-        elif 'Телефон:' in line:
-            company_data['phone'] = line.replace('Телефон:', '').strip()
-        elif 'Контактное лицо:' in line:
-            company_data['contact_person'] = line.replace('Контактное лицо:', '').strip()
-        elif 'Email:' in line:
-            company_data['email'] = line.replace('Email:', '').strip()
-
-    required_fields = ['name', 'inn', 'email']
-    if all(field in company_data for field in required_fields):
+    for match in _FIELD_RE.finditer(text_data):
+        company_data.setdefault(FIELD_LABELS[match.group(1)], match.group(2).strip())
+        if len(company_data) == len(FIELD_LABELS):
+            break
+
+    if all(FIELD_LABELS[label] in company_data for label in REQUIRED_LABELS):
         return company_data
 
     return None
@@ -238,36 +447,60 @@ def create_main_keyboard():
     return markup
 
 
+def create_search_keyboard():
+    """Создает клавиатуру выбора критерия поиска"""
+    markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add(*SEARCH_BUTTONS)
+    return markup
+
+
+# Клавиатуры не меняются, поэтому создаются один раз
+MAIN_KEYBOARD = create_main_keyboard()
+SEARCH_KEYBOARD = create_search_keyboard()
+REMOVE_KEYBOARD = telebot.types.ReplyKeyboardRemove()
+
+
+def _inn_check_digit(digits: List[int], weights: Tuple[int, ...]) -> int:
+    """Расчет контрольной цифры ИНН"""
+    return sum(d * w for d, w in zip(digits, weights)) % 11 % 10
+
+
 def validate_inn(inn: str) -> bool:
-    """Валидация ИНН"""
-    if not inn.isdigit():
-        return False
+    """Валидация ИНН (длина, цифры и контрольные разряды)"""
     if len(inn) not in (10, 12):
         return False
-    return True
+    if not set(inn) <= _DIGITS:
+        return False
+
+    digits = [int(c) for c in inn]
+    if len(digits) == 10:
+        return _inn_check_digit(digits, _INN10_WEIGHTS) == digits[9]
+    return (_inn_check_digit(digits, _INN12_WEIGHTS_1) == digits[10] and
+            _inn_check_digit(digits, _INN12_WEIGHTS_2) == digits[11])
 
 
 def validate_email(email: str) -> bool:
     """Валидация email"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 
 def validate_phone(phone: str) -> bool:
     """Валидация телефона"""
-    phone = phone.replace('+', '').replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
+    phone = phone.translate(_PHONE_STRIP)
     return phone.isdigit() and len(phone) >= 10
 
 
 # Инициализация менеджеров
 db = DatabaseManager()
 api_client = APIClient(API_URL, BOT_ID)
+send_queue = SendQueue(bot)
+EXECUTOR = ThreadPoolExecutor(max_workers=NUM_THREADS)
 
 
 @bot.message_handler(commands=['start'])
 def start_message(message):
     """Обработчик команды /start"""
-    bot.reply_to(message, 'Привет! Выберите действие:', reply_markup=create_main_keyboard())
+    bot.reply_to(message, 'Привет! Выберите действие:', reply_markup=MAIN_KEYBOARD)
 
 
 @bot.message_handler(func=lambda message: message.text == "Помощь")
@@ -288,80 +521,80 @@ def help_message(message):
 def add_company_start(message):
     """Начало процесса добавления компании"""
     user_states[message.chat.id] = {'state': 'waiting_name', 'data': {}}
-    bot.reply_to(message, 'Введите название компании:', reply_markup=telebot.types.ReplyKeyboardRemove())
+    bot.reply_to(message, 'Введите название компании:', reply_markup=REMOVE_KEYBOARD)
 
 
-@bot.message_handler(func=lambda message: message.text == "Показать все компании")
-def show_all_companies(message):
-    """Отображение всех компаний из базы данных"""
-    companies = db.get_all_companies()
+def send_companies_page(chat_id: int, before_id: Optional[int] = None):
+    """Отправка одной страницы списка компаний"""
+    companies = db.get_all_companies(limit=PAGE_SIZE, before_id=before_id)
 
     if not companies:
-        bot.reply_to(message, "В базе данных нет компаний.")
+        text = "В базе данных нет компаний." if before_id is None else "Больше компаний нет."
+        send_queue.put(chat_id, text)
         return
 
-    response = "Список компаний:\n\n"
-    for company in companies:
-        response += format_company_info(company) + "\n\n"
+    header = "Список компаний:\n\n" if before_id is None else "Список компаний (продолжение):\n\n"
+    blocks = (format_company_info(company) for company in companies)
+    messages = list(pack_messages(blocks, header=header))
+
+    markup = None
+    if len(companies) == PAGE_SIZE:
+        markup = telebot.types.InlineKeyboardMarkup()
+        markup.add(telebot.types.InlineKeyboardButton("Следующая страница",
+                                                      callback_data=f"companies_page:{companies[-1][0]}"))
 
-    for i in range(0, len(response), 4096):
-        bot.send_message(message.chat.id, response[i:i + 4096])
+    for text in messages[:-1]:
+        send_queue.put(chat_id, text)
+    send_queue.put(chat_id, messages[-1], reply_markup=markup)
+
+
+@bot.message_handler(func=lambda message: message.text == "Показать все компании")
+def show_all_companies(message):
+    """Отображение всех компаний из базы данных"""
+    send_companies_page(message.chat.id)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('companies_page:'))
+def show_companies_page(call):
+    """Обработка кнопки перехода на следующую страницу списка"""
+    bot.answer_callback_query(call.id)
+    send_companies_page(call.message.chat.id, int(call.data.split(':', 1)[1]))
 
 
 @bot.message_handler(func=lambda message: message.text == "Найти компанию")
 def search_company_start(message):
     """Начало процесса поиска компании"""
-    search_states[message.chat.id] = {'search_type': None, 'search_value': None}
-    markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-    buttons = ["По названию", "По ИНН", "По email"]
-    markup.add(*buttons)
-    bot.reply_to(message, 'Выберите критерий поиска:', reply_markup=markup)
+    user_states[message.chat.id] = {'state': 'waiting_search_type'}
+    bot.reply_to(message, 'Выберите критерий поиска:', reply_markup=SEARCH_KEYBOARD)
 
 
-@bot.message_handler(func=lambda message: message.text in ["По названию", "По ИНН", "По email"])
+@bot.message_handler(func=lambda message: message.text in SEARCH_BUTTONS)
 def set_search_type(message):
     """Установка типа поиска"""
     chat_id = message.chat.id
-    if chat_id not in search_states:
-        search_states[chat_id] = {}
-
-    if message.text == "По названию":
-        search_states[chat_id]['search_type'] = 'названию'
-    elif message.text == "По ИНН":
-        search_states[chat_id]['search_type'] = 'инн'
-    elif message.text == "По email":
-        search_states[chat_id]['search_type'] = 'email'
-
-    bot.reply_to(message, f'Введите значение для поиска по {search_states[chat_id]["search_type"]}:',
-                 reply_markup=telebot.types.ReplyKeyboardRemove())
+    user_states[chat_id] = {'state': 'waiting_search_value', 'search_type': SEARCH_BUTTONS[message.text]}
+    bot.reply_to(message, f'Введите значение для поиска {message.text.lower()}:',
+                 reply_markup=REMOVE_KEYBOARD)
 
 
-@bot.message_handler(func=lambda message: message.chat.id in search_states and
-                                          'search_type' in search_states[message.chat.id] and
-                                          'search_value' not in search_states[message.chat.id])
 def perform_search(message):
     """Выполнение поиска компании"""
     chat_id = message.chat.id
-    search_type = search_states[chat_id]['search_type']
-    search_value = message.text
+    # Состояние забирается атомарно: повторное сообщение из того же чата его уже не найдет
+    state = user_states.pop(chat_id, None)
+    if state is None:
+        return
 
-    companies = db.search_company(search_type, search_value)
+    companies = db.search_company(state['search_type'], message.text)
 
     if not companies:
-        bot.reply_to(message, "Компании не найдены.", reply_markup=create_main_keyboard())
+        bot.reply_to(message, "Компании не найдены.", reply_markup=MAIN_KEYBOARD)
     else:
-        response = f"Найдено компаний: {len(companies)}\n\n"
-        for company in companies:
-            response += format_company_info(company) + "\n\n"
-
-        for i in range(0, len(response), 4096):
-            bot.send_message(chat_id, response[i:i + 4096], reply_markup=create_main_keyboard())
-
-    del search_states[chat_id]
+        blocks = (format_company_info(company) for company in companies)
+        for text in pack_messages(blocks, header=f"Найдено компаний: {len(companies)}\n\n"):
+            send_queue.put(chat_id, text, reply_markup=MAIN_KEYBOARD)
 
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and
-                                          user_states[message.chat.id]['state'] == 'waiting_name')
 def process_company_name(message):
     """Обработка названия компании"""
     chat_id = message.chat.id
@@ -370,15 +603,13 @@ def process_company_name(message):
     bot.reply_to(message, 'Введите ИНН компании (10 или 12 цифр):')
 
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and
-                                          user_states[message.chat.id]['state'] == 'waiting_inn')
 def process_company_inn(message):
     """Обработка ИНН компании"""
     chat_id = message.chat.id
     inn = message.text
 
     if not validate_inn(inn):
-        bot.reply_to(message, 'Некорректный ИНН. Введите 10 или 12 цифр:')
+        bot.reply_to(message, 'Некорректный ИНН. Проверьте номер и введите 10 или 12 цифр:')
         return
 
     user_states[chat_id]['data']['inn'] = inn
@@ -386,8 +617,6 @@ def process_company_inn(message):
     bot.reply_to(message, 'Введите телефон компании:')
 
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and
-                                          user_states[message.chat.id]['state'] == 'waiting_phone')
 def process_company_phone(message):
     """Обработка телефона компании"""
     chat_id = message.chat.id
@@ -402,8 +631,6 @@ def process_company_phone(message):
     bot.reply_to(message, 'Введите контактное лицо:')
 
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and
-                                          user_states[message.chat.id]['state'] == 'waiting_contact')
 def process_company_contact(message):
     """Обработка контактного лица"""
     chat_id = message.chat.id
@@ -412,8 +639,6 @@ def process_company_contact(message):
     bot.reply_to(message, 'Введите email компании:')
 
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and
-                                          user_states[message.chat.id]['state'] == 'waiting_email')
 def process_company_email(message):
     """Обработка email компании"""
     chat_id = message.chat.id
@@ -423,15 +648,16 @@ def process_company_email(message):
         bot.reply_to(message, 'Некорректный email. Введите email в формате example@domain.com:')
         return
 
-    user_states[chat_id]['data']['email'] = email
+    state = user_states.pop(chat_id, None)
+    if state is None:
+        return
+    state['data']['email'] = email
 
     try:
-        company_id = db.save_company(user_states[chat_id]['data'])
-        bot.reply_to(message, '✅ Компания успешно сохранена!', reply_markup=create_main_keyboard())
+        company_id = db.save_company(state['data'])
+        bot.reply_to(message, '✅ Компания успешно сохранена!', reply_markup=MAIN_KEYBOARD)
     except Exception as e:
-        bot.reply_to(message, f'⚠️ Ошибка при сохранении компании: {str(e)}', reply_markup=create_main_keyboard())
-
-    del user_states[chat_id]
+        bot.reply_to(message, f'⚠️ Ошибка при сохранении компании: {str(e)}', reply_markup=MAIN_KEYBOARD)
 
 
 @bot.message_handler(func=lambda message: message.text == "Отправить данные в API")
@@ -439,15 +665,30 @@ def send_to_api_start(message):
     """Начало процесса отправки данных в API"""
     user_states[message.chat.id] = {'state': 'waiting_api_data'}
     bot.reply_to(message, 'Отправьте сообщение или файл с данными компании для обработки API:',
-                 reply_markup=telebot.types.ReplyKeyboardRemove())
+                 reply_markup=REMOVE_KEYBOARD)
+
+
+def save_api_company(message, response_data: Optional[Dict[str, Any]],
+                     files: Optional[List[Dict[str, Any]]] = None):
+    """Проверка и сохранение компании из ответа API"""
+    company_data = parse_api_response(response_data)
+
+    if not company_data:
+        bot.reply_to(message, "ℹ️ API не вернул данных компании в требуемом формате",
+                     reply_markup=MAIN_KEYBOARD)
+    elif not validate_inn(company_data['inn']):
+        bot.reply_to(message, f"⚠️ API вернул некорректный ИНН: {company_data['inn']}. Компания не сохранена.",
+                     reply_markup=MAIN_KEYBOARD)
+    else:
+        db.save_company(company_data, files)
+        bot.reply_to(message, "✅ Компания успешно добавлена из API!", reply_markup=MAIN_KEYBOARD)
 
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and
-                                          user_states[message.chat.id]['state'] == 'waiting_api_data',
-                     content_types=['text'])
 def process_text_for_api(message):
     """Обработка текстовых сообщений для API"""
     chat_id = message.chat.id
+    if user_states.pop(chat_id, None) is None:
+        return
 
     try:
         response_data = api_client.send_request(
@@ -456,76 +697,100 @@ def process_text_for_api(message):
             message.text
         )
 
-        company_data = parse_api_response(response_data)
-
-        if company_data:
-            company_id = db.save_company(company_data)
-            bot.reply_to(message, "✅ Компания успешно добавлена из API!", reply_markup=create_main_keyboard())
-        else:
-            bot.reply_to(message, "ℹ️ API не вернул данных компании в требуемом формате",
-                         reply_markup=create_main_keyboard())
+        save_api_company(message, response_data)
 
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
-        bot.reply_to(message, f"⚠️ Ошибка: {str(e)}", reply_markup=create_main_keyboard())
+        bot.reply_to(message, f"⚠️ Ошибка: {str(e)}", reply_markup=MAIN_KEYBOARD)
 
-    if chat_id in user_states:
-        del user_states[chat_id]
 
+def _ingest_file(message, content: Dict[str, Any], files: List[Dict[str, Any]]):
+    """Отправка файла в API и сохранение результата (выполняется в пуле потоков)"""
+    try:
+        response_data = api_client.send_request(
+            message.chat.id,
+            message.message_id,
+            content
+        )
+
+        save_api_company(message, response_data, files)
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and
-                                          user_states[message.chat.id]['state'] == 'waiting_api_data',
-                     content_types=['photo', 'document', 'audio', 'video'])
+    except Exception as e:
+        logger.error(f"Error processing file: {str(e)}")
+        bot.reply_to(message, f"⚠️ Ошибка: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+
+@bot.message_handler(func=lambda message: user_states.get(message.chat.id, {}).get('state') == 'waiting_api_data',
+                     content_types=list(FILE_EXTRACTORS))
 def process_files_for_api(message):
     """Обработка файловых сообщений для API"""
     chat_id = message.chat.id
+    if user_states.pop(chat_id, None) is None:
+        return
 
     try:
-        file_info = bot.get_file(message.document.file_id if message.content_type == 'document'
-                                 else message.photo[-1].file_id if message.content_type == 'photo'
-        else getattr(message, message.content_type).file_id)
+        attachment = FILE_EXTRACTORS[message.content_type](message)
+        file_info = bot.get_file(attachment.file_id)
 
-        file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
+        file_url = FILE_URL_PREFIX + file_info.file_path
+        files = [{'url': file_url, 'type': message.content_type, 'caption': message.caption}]
 
         content = {
             'file': {
                 'file_url': file_url,
                 'file_type': message.content_type,
-                'file_size': getattr(getattr(message, message.content_type), 'file_size', 0),
+                'file_size': attachment.file_size or 0,
                 'caption': message.caption or ""
             }
         }
 
-        response_data = api_client.send_request(
-            chat_id,
-            message.message_id,
-            content
-        )
-
-        company_data = parse_api_response(response_data)
-
-        if company_data:
-            company_id = db.save_company(company_data)
-            db.save_file(
-                company_id=company_id,
-                file_url=file_url,
-                file_type=message.content_type,
-                caption=message.caption
-            )
-            bot.reply_to(message, "✅ Компания успешно добавлена из API!", reply_markup=create_main_keyboard())
-        else:
-            bot.reply_to(message, "ℹ️ API не вернул данных компании в требуемом формате",
-                         reply_markup=create_main_keyboard())
+        bot.reply_to(message, "⏳ Обрабатывается…")
+        EXECUTOR.submit(_ingest_file, message, content, files)
 
     except Exception as e:
         logger.error(f"Error processing file: {str(e)}")
-        bot.reply_to(message, f"⚠️ Ошибка: {str(e)}", reply_markup=create_main_keyboard())
+        bot.reply_to(message, f"⚠️ Ошибка: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+
+# Обработчики состояний диалога
+STATE_HANDLERS = {
+    'waiting_search_value': perform_search,
+    'waiting_name': process_company_name,
+    'waiting_inn': process_company_inn,
+    'waiting_phone': process_company_phone,
+    'waiting_contact': process_company_contact,
+    'waiting_email': process_company_email,
+    'waiting_api_data': process_text_for_api
+}
+
+
+@bot.message_handler(func=lambda message: message.chat.id in user_states)
+def dispatch_state(message):
+    """Передача сообщения обработчику текущего состояния диалога"""
+    chat_id = message.chat.id
+    handler = STATE_HANDLERS.get(user_states.get(chat_id, {}).get('state'))
+    if handler:
+        handler(message)
 
-    if chat_id in user_states:
-        del user_states[chat_id]
+
+def schedule_maintenance():
+    """Планирование обслуживания базы данных через MAINTENANCE_INTERVAL секунд"""
+    timer = threading.Timer(MAINTENANCE_INTERVAL, run_maintenance)
+    timer.daemon = True
+    timer.start()
+
+
+def run_maintenance():
+    """Периодическое обслуживание базы данных (ANALYZE)"""
+    try:
+        db.maintenance()
+    except Exception as e:
+        logger.error(f"Error during database maintenance: {str(e)}")
+    schedule_maintenance()
 
 
 # Запуск бота
 if __name__ == '__main__':
     logger.info("Starting bot...")
-    bot.polling(none_stop=True)
\ No newline at end of file
+    schedule_maintenance()
+    bot.infinity_polling(long_polling_timeout=30, skip_pending=True)
\ No newline at end of file